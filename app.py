@@ -2,6 +2,10 @@ import os
 import logging
 import threading
 import json
+import hmac
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from fastapi import FastAPI, Response, status, Request, BackgroundTasks, HTTPException
 from fastapi.responses import JSONResponse
@@ -16,6 +20,7 @@ from google.oauth2 import service_account
 import asyncio
 from typing import Dict, Set
 import pytz
+import memory_monitor
 #Prueba
 # Load environment variables
 load_dotenv()
@@ -24,8 +29,53 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logger.opt(colors=True)
 
-# Store processed event IDs to prevent duplicate processing
-processed_events: Set[str] = set()
+# Store processed event IDs (with the time they were seen) to prevent duplicate
+# processing. Slack retries within a few minutes, so old IDs can be dropped.
+PROCESSED_EVENTS_TTL = int(os.getenv("PROCESSED_EVENTS_TTL", "900"))
+PROCESSED_EVENTS_MAX = int(os.getenv("PROCESSED_EVENTS_MAX", "10000"))
+# Tighter limits applied under memory pressure. Slack's last retry arrives about
+# 5 minutes after the original delivery, so a 6 minute window still dedupes it.
+PROCESSED_EVENTS_PRESSURE_TTL = int(os.getenv("PROCESSED_EVENTS_PRESSURE_TTL", "360"))
+PROCESSED_EVENTS_PRESSURE_MAX = int(os.getenv("PROCESSED_EVENTS_PRESSURE_MAX", "1000"))
+processed_events: Dict[str, float] = {}
+# The memory monitor prunes from its own thread, so every access takes this lock
+processed_events_lock = threading.Lock()
+
+def mark_event_processed(event_id):
+    """Record an event ID, returning False if it was already processed."""
+    with processed_events_lock:
+        if event_id in processed_events:
+            return False
+        processed_events[event_id] = time.time()
+        _prune_processed_events(PROCESSED_EVENTS_TTL, PROCESSED_EVENTS_MAX)
+    return True
+
+def forget_event(event_id):
+    """Remove an event ID so a Slack retry of it is processed again."""
+    with processed_events_lock:
+        processed_events.pop(event_id, None)
+
+def prune_processed_events():
+    """Drop event IDs older than the TTL and keep at most PROCESSED_EVENTS_MAX."""
+    with processed_events_lock:
+        _prune_processed_events(PROCESSED_EVENTS_TTL, PROCESSED_EVENTS_MAX)
+
+def evict_processed_events():
+    """Shrink processed_events to the memory-pressure TTL and size limits."""
+    with processed_events_lock:
+        _prune_processed_events(PROCESSED_EVENTS_PRESSURE_TTL, PROCESSED_EVENTS_PRESSURE_MAX)
+
+def _prune_processed_events(ttl, max_events):
+    # Must be called with processed_events_lock held
+    cutoff = time.time() - ttl
+    while processed_events:
+        # Dicts keep insertion order, so the first entry is the oldest
+        oldest_id = next(iter(processed_events))
+        if processed_events[oldest_id] >= cutoff and len(processed_events) <= max_events:
+            break
+        del processed_events[oldest_id]
+
+memory_monitor.register_store("processed_events", processed_events, evict=evict_processed_events)
 
 # BigQuery Configuration
 BIGQUERY_PROJECT_ID = os.getenv("BIGQUERY_PROJECT_ID", "neto-cloud")
@@ -36,6 +86,18 @@ BIGQUERY_LOCATION = os.getenv("BIGQUERY_LOCATION", "us-central1")
 # Initialize BigQuery client as None
 bigquery_client = None
 
+# Dedicated thread pool for blocking BigQuery calls, so they don't compete with
+# the Slack and OpenAI calls running in the default executor
+bigquery_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BIGQUERY_MAX_WORKERS", "4")),
+    thread_name_prefix="bigquery"
+)
+
+async def run_blocking(func, *args, executor=None, **kwargs):
+    """Run a blocking call in a thread pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
 # Configure Google Cloud credentials
 try:
     creds_json = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON")
@@ -127,13 +189,10 @@ async def slack_events(request: Request):
         # Generate a unique ID for this event
         event_id = f"{data.get('event_id') or ''}:{data.get('event', {}).get('ts') or ''}"
         
-        # Check if we've already processed this event
-        if event_id in processed_events:
+        # Check if we've already processed this event and add it to processed events
+        if not mark_event_processed(event_id):
             logger.info(f"Skipping already processed event: {event_id}")
             return {"status": "already_processed"}
-            
-        # Add to processed events
-        processed_events.add(event_id)
         
         # Log the request for debugging
         logger.info("\n" + "="*50)
@@ -192,42 +251,7 @@ async def slack_events(request: Request):
                 if event.get("channel_type") == "im":
                     logger.info(f"Processing DM from user {user_id}: {text}")
                     
-                    try:
-                        # Add "eyes" reaction to show we've seen the message
-                        slack_app.client.reactions_add(
-                            channel=channel_id,
-                            timestamp=event.get("ts"),
-                            name="eyes"
-                        )
-                        
-                        # Process the message and generate response
-                        await process_message(channel_id, user_id, text, event)
-                        
-                        # Change reaction to white check mark in green circle when done
-                        slack_app.client.reactions_remove(
-                            channel=channel_id,
-                            timestamp=event.get("ts"),
-                            name="eyes"
-                        )
-                        slack_app.client.reactions_add(
-                            channel=channel_id,
-                            timestamp=event.get("ts"),
-                            name="white_check_mark"
-                        )
-                        
-                    except Exception as e:
-                        logger.error(f"Error processing message: {str(e)}", exc_info=True)
-                        # If there was an error, remove eyes and add X
-                        slack_app.client.reactions_remove(
-                            channel=channel_id,
-                            timestamp=event.get("ts"),
-                            name="eyes"
-                        )
-                        slack_app.client.reactions_add(
-                            channel=channel_id,
-                            timestamp=event.get("ts"),
-                            name="x"
-                        )
+                    await handle_message(channel_id, user_id, text, event)
                 
                 # Handle mentions in channels
                 elif f"<@{bot_id}>" in text:
@@ -235,42 +259,7 @@ async def slack_events(request: Request):
                     # Remove the mention from the message
                     clean_text = text.replace(f'<@{bot_id}>', '').strip()
                     
-                    try:
-                        # Add "eyes" reaction to show we've seen the message
-                        slack_app.client.reactions_add(
-                            channel=channel_id,
-                            timestamp=event.get("ts"),
-                            name="eyes"
-                        )
-                        
-                        # Process the message and generate response
-                        await process_message(channel_id, user_id, clean_text, event)
-                        
-                        # Change reaction to white check mark in green circle when done
-                        slack_app.client.reactions_remove(
-                            channel=channel_id,
-                            timestamp=event.get("ts"),
-                            name="eyes"
-                        )
-                        slack_app.client.reactions_add(
-                            channel=channel_id,
-                            timestamp=event.get("ts"),
-                            name="white_check_mark"
-                        )
-                        
-                    except Exception as e:
-                        logger.error(f"Error processing mention: {str(e)}", exc_info=True)
-                        # If there was an error, remove eyes and add X
-                        slack_app.client.reactions_remove(
-                            channel=channel_id,
-                            timestamp=event.get("ts"),
-                            name="eyes"
-                        )
-                        slack_app.client.reactions_add(
-                            channel=channel_id,
-                            timestamp=event.get("ts"),
-                            name="x"
-                        )
+                    await handle_message(channel_id, user_id, clean_text, event)
             
             # Return 200 OK to acknowledge receipt
             return {"status": "ok"}
@@ -281,15 +270,64 @@ async def slack_events(request: Request):
     except Exception as e:
         logger.error(f"Unexpected error in slack_events endpoint: {str(e)}", exc_info=True)
         # Don't add to processed_events if there was an error, so we can retry
-        if 'event_id' in locals() and event_id in processed_events:
-            processed_events.remove(event_id)
+        if 'event_id' in locals():
+            forget_event(event_id)
         return JSONResponse(status_code=500, content={"error": "Internal server error"})
 
+async def handle_message(channel_id, user_id, text, event):
+    """Run the pipeline for a message, overlapping the stages that don't depend on each other."""
+    ts = event.get("ts")
+    
+    # Add "eyes" reaction to show we've seen the message while the history is fetched
+    eyes_task = asyncio.ensure_future(
+        run_blocking(slack_app.client.reactions_add, channel=channel_id, timestamp=ts, name="eyes")
+    )
+    
+    try:
+        # Process the message and generate response
+        message_data = await process_message(channel_id, user_id, text, event)
+    except Exception as e:
+        logger.error(f"Error processing message: {str(e)}", exc_info=True)
+        # Replace eyes with X; reactions are best-effort so they can't trigger a Slack retry
+        await swap_reaction(channel_id, ts, "x", eyes_task)
+        return
+    
+    # The reply is already posted: change reaction to white check mark and save
+    # to database at the same time, without letting a reaction failure skip the save
+    await asyncio.gather(
+        swap_reaction(channel_id, ts, "white_check_mark", eyes_task),
+        persist_message(message_data)
+    )
+
+async def swap_reaction(channel_id, ts, name, eyes_task):
+    """Replace the "eyes" reaction on a message with another one (best-effort)."""
+    eyes_result = (await asyncio.gather(eyes_task, return_exceptions=True))[0]
+    if isinstance(eyes_result, Exception):
+        logger.warning(f"Could not add eyes reaction: {str(eyes_result)}")
+    
+    calls = [run_blocking(slack_app.client.reactions_add, channel=channel_id, timestamp=ts, name=name)]
+    if not isinstance(eyes_result, Exception):
+        calls.append(
+            run_blocking(slack_app.client.reactions_remove, channel=channel_id, timestamp=ts, name="eyes")
+        )
+    for result in await asyncio.gather(*calls, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.warning(f"Could not update reaction to {name}: {str(result)}")
+
+async def persist_message(message_data):
+    """Save a processed message to BigQuery using the dedicated thread pool."""
+    saved = await run_blocking(save_to_bigquery, message_data, executor=bigquery_executor)
+    if not saved:
+        logger.error("Failed to save message to database")
+    return saved
+
 async def process_message(channel_id, user_id, message, event):
-    """Process a message and generate a response."""
+    """Process a message, post the response and return the data to persist."""
     try:
         # Get conversation history
-        conversation_history = get_conversation_history(channel_id, user_id)
+        conversation_history = await run_blocking(
+            get_conversation_history, channel_id, user_id, executor=bigquery_executor
+        )
         
         # Prepare messages for the AI model
         messages = [
@@ -305,28 +343,28 @@ async def process_message(channel_id, user_id, message, event):
         
         # Add the current message
         messages.append({"role": "user", "content": message})
+        memory_monitor.record_gauge("conversation_messages", messages)
         
-        # Get AI response - this is the only part that needs to be awaited
-        response = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: get_chat_completion(
-                messages=messages,
-                model=os.environ.get("OPENAI_MODEL", "gpt-4"),
-                max_tokens=1000,
-                temperature=0.7
-            )
+        # Get AI response
+        response = await run_blocking(
+            get_chat_completion,
+            messages=messages,
+            model=os.environ.get("OPENAI_MODEL", "gpt-4"),
+            max_tokens=1000,
+            temperature=0.7
         )
         
         ai_response = response.choices[0].message.content
         
-        # Send the response - non-blocking
-        slack_app.client.chat_postMessage(
+        # Send the response
+        await run_blocking(
+            slack_app.client.chat_postMessage,
             channel=channel_id,
             text=ai_response
         )
         
-        # Save to database - non-blocking
-        message_data = {
+        # Data to save to database, persisted by the caller
+        return {
             "message_ts": datetime.utcfromtimestamp(float(event.get("ts"))).strftime('%Y-%m-%d %H:%M:%S'),
             "channel_id": channel_id,
             "user_id": user_id,
@@ -338,9 +376,6 @@ async def process_message(channel_id, user_id, message, event):
             "total_tokens": response.usage.get("total_tokens", 0)
         }
         
-        if not save_to_bigquery(message_data):
-            logger.error("Failed to save message to database")
-        
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}", exc_info=True)
         raise
@@ -359,9 +394,33 @@ async def health_check():
     }
     return status
 
+# Memory debug endpoints, only enabled when DEBUG_TOKEN is set
+def verify_debug_token(request: Request):
+    debug_token = os.environ.get("DEBUG_TOKEN")
+    if not debug_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    provided_token = request.headers.get("x-debug-token") or ""
+    if not hmac.compare_digest(provided_token.encode("utf-8"), debug_token.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+
+# Snapshots, gc and object sizing can take seconds on a large heap, so they run
+# in a thread instead of stalling Slack acks on the event loop
+@fastapi_app.get("/debug/memory")
+async def debug_memory(request: Request, top: int = 10, trace: bool = False):
+    verify_debug_token(request)
+    return await run_blocking(memory_monitor.memory_report, top=top, trace=trace)
+
+@fastapi_app.post("/debug/memory/evict")
+async def debug_memory_evict(request: Request):
+    verify_debug_token(request)
+    return await run_blocking(memory_monitor.evict_caches, reason="manual")
+
 # Make the app callable for Gunicorn
 app = fastapi_app
 
+# Watch RSS and evict internal stores before the container limit is reached
+memory_monitor.start_monitor()
+
 # Configure OpenAI
 openai_api_key = os.environ.get("OPENAI_API_KEY")
 if not openai_api_key:
@@ -561,7 +620,7 @@ else:
     # Cleanup function
     def cleanup():
         logger.info("Shutting down Slack handler...")
-        # Add any cleanup code here if needed
+        bigquery_executor.shutdown(wait=False)
     
     # Register cleanup function
     atexit.register(cleanup)
@@ -0,0 +1,178 @@
+"""Benchmark de latencia del pipeline por mensaje.
+
+Envía el mismo mensaje directo firmado al endpoint ``slack_events`` de dos
+versiones de app.py: la de una revisión de git indicada con ``--baseline-ref``
+(por ejemplo, la versión secuencial original) y la actual, que ejecuta en
+paralelo las etapas independientes. Las llamadas a Slack, OpenAI y BigQuery se sustituyen por
+llamadas bloqueantes con latencia fija, así que la diferencia solo depende de
+cómo cada versión organiza las etapas.
+
+Uso:
+    python bench_pipeline.py --baseline-ref origin/main --messages 20
+"""
+import os
+import sys
+import json
+import time
+import types
+import asyncio
+import argparse
+import subprocess
+from types import SimpleNamespace
+from unittest import mock
+
+# app.py requires these at import time; no real calls are made
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-benchmark")
+os.environ.setdefault("SLACK_SIGNING_SECRET", "benchmark")
+os.environ.setdefault("MEMORY_CHECK_INTERVAL", "0")
+os.environ.pop("GOOGLE_APPLICATION_CREDENTIALS_JSON", None)
+
+from slack_sdk.signature import SignatureVerifier
+
+
+class FakeSlackClient:
+    """Cliente de Slack con latencia fija por llamada."""
+
+    def __init__(self, reaction_latency, post_latency):
+        self.reaction_latency = reaction_latency
+        self.post_latency = post_latency
+
+    def auth_test(self):
+        return {"user_id": "U-BOT"}
+
+    def reactions_add(self, **kwargs):
+        time.sleep(self.reaction_latency)
+
+    def reactions_remove(self, **kwargs):
+        time.sleep(self.reaction_latency)
+
+    def chat_postMessage(self, **kwargs):
+        time.sleep(self.post_latency)
+
+
+class FakeRequest:
+    """Request de FastAPI mínima con un evento de Slack firmado."""
+
+    def __init__(self, payload):
+        self._body = json.dumps(payload).encode("utf-8")
+        timestamp = str(int(time.time()))
+        signature = SignatureVerifier(os.environ["SLACK_SIGNING_SECRET"]).generate_signature(
+            timestamp=timestamp, body=self._body.decode("utf-8")
+        )
+        self.headers = {"x-slack-signature": signature, "x-slack-request-timestamp": timestamp}
+
+    async def body(self):
+        return self._body
+
+    async def json(self):
+        return json.loads(self._body)
+
+
+def load_app(name, source):
+    """Importa una versión de app.py sin la verificación de Slack al crear la app Bolt."""
+    module = types.ModuleType(name)
+    module.__file__ = f"<{name}>"
+    sys.modules[name] = module
+    with mock.patch("slack_bolt.App"):
+        exec(compile(source, module.__file__, "exec"), module.__dict__)
+    return module
+
+
+def install_fakes(module, args):
+    """Sustituye los clientes externos de una versión de app.py por versiones con latencia fija."""
+    module.slack_app = SimpleNamespace(client=FakeSlackClient(args.reaction, args.post))
+
+    def get_conversation_history(channel_id, user_id, limit=10):
+        time.sleep(args.history)
+        return [{"message_text": "Hola", "bot_response": "¿En qué puedo ayudarte?"}]
+
+    def get_chat_completion(messages, model=None, max_tokens=1000, temperature=0.3):
+        time.sleep(args.completion)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Respuesta"))],
+            usage={"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+        )
+
+    def save_to_bigquery(message_data):
+        time.sleep(args.save)
+        return True
+
+    module.get_conversation_history = get_conversation_history
+    module.get_chat_completion = get_chat_completion
+    module.save_to_bigquery = save_to_bigquery
+
+
+async def measure(module, messages):
+    """Devuelve la latencia de slack_events para cada mensaje, procesados uno tras otro."""
+    latencies = []
+    for index in range(messages):
+        payload = {
+            "type": "event_callback",
+            "event_id": f"Ev{module.__name__}{index}",
+            "event": {
+                "type": "message",
+                "channel_type": "im",
+                "channel": "D-BENCH",
+                "user": "U-BENCH",
+                "text": f"Mensaje {index}",
+                "ts": f"{time.time():.6f}",
+            },
+        }
+        start = time.perf_counter()
+        result = await module.slack_events(FakeRequest(payload))
+        latencies.append(time.perf_counter() - start)
+        if result != {"status": "ok"}:
+            raise RuntimeError(f"Respuesta inesperada de {module.__name__}: {result}")
+    return latencies
+
+
+def summarize(name, latencies):
+    ordered = sorted(latencies)
+    mean = sum(ordered) / len(ordered)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f"{name:<12} media: {mean * 1000:8.1f} ms   p95: {p95 * 1000:8.1f} ms")
+    return mean
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark de latencia del pipeline por mensaje")
+    parser.add_argument("--baseline-ref", required=True,
+                        help="Revisión de git (rama, tag o commit) con la versión de app.py a comparar")
+    parser.add_argument("--messages", type=int, default=10, help="Mensajes a procesar por versión")
+    parser.add_argument("--reaction", type=float, default=0.15, help="Latencia de cada llamada de reacción (s)")
+    parser.add_argument("--history", type=float, default=0.6, help="Latencia de get_conversation_history (s)")
+    parser.add_argument("--completion", type=float, default=1.5, help="Latencia del completion (s)")
+    parser.add_argument("--post", type=float, default=0.2, help="Latencia de chat_postMessage (s)")
+    parser.add_argument("--save", type=float, default=0.5, help="Latencia de save_to_bigquery (s)")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        baseline_source = subprocess.check_output(
+            ["git", "show", f"{args.baseline_ref}:app.py"], cwd=repo_dir, text=True,
+            stderr=subprocess.PIPE
+        )
+    except (subprocess.CalledProcessError, OSError) as e:
+        detail = getattr(e, "stderr", None) or str(e)
+        sys.exit(f"No se pudo leer app.py en la revisión '{args.baseline_ref}': {detail.strip()}")
+    with open(os.path.join(repo_dir, "app.py"), encoding="utf-8") as app_file:
+        current_source = app_file.read()
+
+    baseline = load_app("app_baseline", baseline_source)
+    current = load_app("app_current", current_source)
+    install_fakes(baseline, args)
+    install_fakes(current, args)
+
+    print(f"Procesando {args.messages} mensajes por versión (base: {args.baseline_ref})...\n")
+    before = summarize("base", await measure(baseline, args.messages))
+    after = summarize("actual", await measure(current, args.messages))
+    print(f"\nGanancia por mensaje: {(before - after) * 1000:.1f} ms "
+          f"({(1 - after / before) * 100:.1f}%)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
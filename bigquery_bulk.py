@@ -0,0 +1,558 @@
+import os
+import sys
+import csv
+import gzip
+import json
+import argparse
+import tempfile
+from collections import OrderedDict
+from datetime import datetime, date
+import logging
+from google.cloud import bigquery
+from google.oauth2 import service_account
+from dotenv import load_dotenv
+import pytz
+
+# Cargar variables de entorno desde .env
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+BIGQUERY_PROJECT_ID = os.getenv("BIGQUERY_PROJECT_ID", "neto-cloud")
+BIGQUERY_DATASET = os.getenv("BIGQUERY_DATASET", "agente_vokse")
+BIGQUERY_TABLE = os.getenv("BIGQUERY_TABLE", "chat_messages")
+BIGQUERY_LOCATION = os.getenv("BIGQUERY_LOCATION", "us-central1")
+
+# Same limits and format that save_to_bigquery applies in app.py
+MAX_TEXT_LENGTH = 10000
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+mexico_tz = pytz.timezone('America/Mexico_City')
+
+# Slack retries arrive shortly after the original delivery, so only the most
+# recent event keys are remembered, like PROCESSED_EVENTS_MAX in app.py
+DEDUPE_WINDOW = 10000
+
+# Chunks already loaded and the run they belong to, kept in the staging directory
+# to resume a backfill
+LOADED_MANIFEST = 'loaded_chunks.json'
+
+CHAT_MESSAGE_COLUMNS = [
+    'user_id', 'message_ts', 'channel_id', 'message_text', 'bot_response', 'message_type',
+    'input_tokens', 'output_tokens', 'total_tokens', 'created_at', 'updated_at'
+]
+
+
+def get_bigquery_client():
+    """Crea el cliente de BigQuery a partir de GOOGLE_APPLICATION_CREDENTIALS_JSON."""
+    creds_json = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON")
+    if not creds_json or creds_json.strip() == "":
+        raise ValueError("GOOGLE_APPLICATION_CREDENTIALS_JSON no está configurado")
+
+    credentials_info = json.loads(creds_json)
+    credentials = service_account.Credentials.from_service_account_info(credentials_info)
+    return bigquery.Client(
+        project=credentials_info.get('project_id', BIGQUERY_PROJECT_ID),
+        credentials=credentials,
+        location=BIGQUERY_LOCATION
+    )
+
+
+def open_text(path, mode='rt'):
+    """Abre un archivo de texto, descomprimiendo/comprimiendo con gzip si termina en .gz."""
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8')
+    return open(path, mode, encoding='utf-8', newline='' if 'w' in mode else None)
+
+
+def iter_records(paths):
+    """Lee registros JSON línea por línea sin cargar los archivos completos en memoria."""
+    for path in paths:
+        with open_text(path) as input_file:
+            for line_number, line in enumerate(input_file, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    logger.warning(f"Línea inválida en {path}:{line_number}: {str(e)}")
+
+
+def format_timestamp(value, field_type=None):
+    """Convierte un ts de Slack, un epoch o una fecha ISO al formato de la tabla.
+
+    Los ts de Slack y los epoch se guardan en hora de México, igual que
+    save_to_bigquery. Las fechas con zona horaria (por ejemplo columnas
+    TIMESTAMP exportadas) conservan el instante original si la columna destino
+    es TIMESTAMP o si se desconoce su tipo; solo se pasan a hora de México sin
+    zona para columnas DATETIME o STRING.
+
+    Args:
+        value: Valor a convertir.
+        field_type (str, optional): Tipo de la columna destino en BigQuery.
+
+    Raises:
+        ValueError: Si el valor no es una fecha válida.
+    """
+    if value in (None, ''):
+        return None
+    if isinstance(value, (int, float)):
+        return _format_epoch(value)
+    value = str(value)
+    try:
+        # Slack "ts" values are epoch seconds as strings, e.g. "1700000000.123456"
+        epoch = float(value)
+    except ValueError:
+        epoch = None
+    if epoch is not None:
+        return _format_epoch(epoch)
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        return parsed.strftime(TIMESTAMP_FORMAT)
+    if field_type in (None, 'TIMESTAMP'):
+        # BigQuery reads the offset, so the instant is preserved on reload
+        return parsed.isoformat(sep=' ')
+    return parsed.astimezone(mexico_tz).strftime(TIMESTAMP_FORMAT)
+
+
+def _format_epoch(value):
+    try:
+        return datetime.fromtimestamp(float(value), mexico_tz).strftime(TIMESTAMP_FORMAT)
+    except (OverflowError, OSError) as e:
+        raise ValueError(f"Timestamp fuera de rango: {value}") from e
+
+
+def is_slack_event(record):
+    """Indica si el registro es un evento de Slack y no una fila exportada."""
+    return isinstance(record.get('event'), dict) or ('ts' in record and 'message_text' not in record)
+
+
+def slack_event_key(record):
+    """Clave de deduplicación de un evento de Slack, igual a la que usa app.py.
+
+    Returns:
+        str: ``event_id:ts``, o None si el registro no trae ``event_id``. Sin él
+        no se deduplica: los ``ts`` de Slack solo son únicos dentro de un canal.
+    """
+    event_id = record.get('event_id')
+    if not event_id:
+        return None
+    event = record.get('event') if isinstance(record.get('event'), dict) else record
+    return f"{event_id}:{event.get('ts') or ''}"
+
+
+def get_bot_user_id(record, default=None):
+    """Obtiene el user ID del bot desde las autorizaciones del evento, si vienen incluidas."""
+    for authorization in record.get('authorizations') or []:
+        if authorization.get('is_bot') and authorization.get('user_id'):
+            return authorization['user_id']
+    return default
+
+
+def to_chat_message_row(record, bot_user_id=None, field_types=None):
+    """Convierte un registro histórico al formato de fila de chat_messages.
+
+    Acepta filas ya exportadas de chat_messages, eventos de Slack
+    (``{"event": {...}}`` o el evento directamente) y registros genéricos con
+    ``text``/``body``. Los eventos de Slack pasan por los mismos filtros que
+    app.py: se omiten mensajes de bots y subtipos, y se quita la mención al bot.
+
+    Args:
+        record (dict): Registro leído del archivo de entrada.
+        bot_user_id (str, optional): User ID del bot para quitar sus menciones.
+        field_types (dict, optional): Tipos de las columnas de la tabla destino.
+
+    Returns:
+        dict: La fila lista para cargar, o None si el registro no tiene mensaje.
+    """
+    if not isinstance(record, dict):
+        return None
+
+    event = record.get('event') if isinstance(record.get('event'), dict) else record
+    message_text = event.get('message_text') or event.get('text') or event.get('body')
+
+    if is_slack_event(record):
+        # Skip the bot's own replies, message_changed and other subtypes
+        if event.get('bot_id') or event.get('subtype'):
+            return None
+        bot_user_id = get_bot_user_id(record, bot_user_id)
+        message_text = (message_text or '').strip()
+        if bot_user_id and event.get('channel_type') != 'im':
+            # The app only answers channel messages that mention the bot
+            if f"<@{bot_user_id}>" not in message_text:
+                return None
+            message_text = message_text.replace(f"<@{bot_user_id}>", '').strip()
+
+    if not message_text:
+        return None
+
+    field_types = field_types or {}
+    message_ts = format_timestamp(event.get('message_ts') or event.get('ts') or event.get('created_at'),
+                                  field_types.get('message_ts'))
+    if not message_ts:
+        message_ts = datetime.now(mexico_tz).strftime(TIMESTAMP_FORMAT)
+
+    return {
+        'user_id': str(event.get('user_id') or event.get('user') or ''),
+        'message_ts': message_ts,
+        'channel_id': str(event.get('channel_id') or event.get('channel') or ''),
+        'message_text': str(message_text)[:MAX_TEXT_LENGTH],
+        'bot_response': str(event.get('bot_response') or '')[:MAX_TEXT_LENGTH],
+        'message_type': event.get('message_type') or event.get('type') or 'message',
+        'input_tokens': int(event.get('input_tokens') or 0),
+        'output_tokens': int(event.get('output_tokens') or 0),
+        'total_tokens': int(event.get('total_tokens') or 0),
+        'created_at': format_timestamp(event.get('created_at'), field_types.get('created_at')) or message_ts,
+        'updated_at': format_timestamp(event.get('updated_at'), field_types.get('updated_at')) or message_ts
+    }
+
+
+class ChunkWriter:
+    """Escribe filas en archivos locales por bloques de tamaño fijo.
+
+    Cada bloque es un archivo NDJSON comprimido con gzip o, si pyarrow está
+    instalado y se pide ``parquet``, un archivo Parquet. Solo se mantiene en
+    memoria un lote de filas a la vez.
+    """
+
+    def __init__(self, directory, file_format='ndjson', chunk_rows=500000, batch_rows=10000, table_schema=None):
+        self.directory = directory
+        self.file_format = file_format
+        self.chunk_rows = chunk_rows
+        self.batch_rows = batch_rows
+        self.completed = []
+        self._file = None
+        self._path = None
+        self._chunk_index = 0
+        self._rows_in_chunk = 0
+        self._batch = []
+
+        if file_format == 'parquet':
+            import pyarrow
+            import pyarrow.parquet
+            self._pa = pyarrow
+            self._pq = pyarrow.parquet
+            self._schema, self._datetime_fields = self._parquet_schema(table_schema)
+
+    def write(self, row):
+        if self._file is None:
+            self._open_chunk()
+        if self.file_format == 'parquet':
+            self._batch.append(row)
+            if len(self._batch) >= self.batch_rows:
+                self._flush_batch()
+        else:
+            self._file.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self._rows_in_chunk += 1
+        if self._rows_in_chunk >= self.chunk_rows:
+            self._close_chunk()
+
+    def close(self):
+        if self._file is not None:
+            self._close_chunk()
+        return self.completed
+
+    def _open_chunk(self):
+        if self.file_format == 'parquet':
+            self._path = os.path.join(self.directory, f"chunk_{self._chunk_index:05d}.parquet")
+            self._file = self._pq.ParquetWriter(self._path, self._schema, compression='snappy')
+        else:
+            self._path = os.path.join(self.directory, f"chunk_{self._chunk_index:05d}.json.gz")
+            self._file = gzip.open(self._path, 'wt', encoding='utf-8')
+        self._chunk_index += 1
+        self._rows_in_chunk = 0
+
+    def _close_chunk(self):
+        if self.file_format == 'parquet':
+            self._flush_batch()
+        self._file.close()
+        self.completed.append((self._path, self._rows_in_chunk))
+        logger.info(f"Bloque escrito: {self._path} ({self._rows_in_chunk} filas)")
+        self._file = None
+
+    def _flush_batch(self):
+        if not self._batch:
+            return
+        for row in self._batch:
+            for field, aware in self._datetime_fields.items():
+                value = datetime.fromisoformat(row[field])
+                if aware:
+                    # Naive strings are read as UTC by BigQuery, keep the same meaning here
+                    value = value.astimezone(pytz.utc) if value.tzinfo else pytz.utc.localize(value)
+                else:
+                    value = value.replace(tzinfo=None)
+                row[field] = value
+        table = self._pa.Table.from_pylist(self._batch, schema=self._schema)
+        self._file.write_table(table)
+        self._batch = []
+
+    def _parquet_schema(self, table_schema):
+        """Construye el esquema Parquet a partir del esquema de la tabla destino.
+
+        Parquet no convierte texto a DATETIME/TIMESTAMP al cargar, así que las
+        columnas de fecha se escriben con el tipo que espera la tabla.
+        """
+        pa = self._pa
+        bigquery_types = {field.name: field.field_type for field in (table_schema or [])}
+        fields, datetime_fields = [], {}
+        for name in CHAT_MESSAGE_COLUMNS:
+            field_type = bigquery_types.get(name, 'INTEGER' if name.endswith('_tokens') else 'STRING')
+            if field_type in ('INTEGER', 'INT64'):
+                fields.append((name, pa.int64()))
+            elif field_type == 'DATETIME':
+                fields.append((name, pa.timestamp('us')))
+                datetime_fields[name] = False
+            elif field_type == 'TIMESTAMP':
+                fields.append((name, pa.timestamp('us', tz='UTC')))
+                datetime_fields[name] = True
+            else:
+                fields.append((name, pa.string()))
+        return pa.schema(fields), datetime_fields
+
+
+def load_file(client, table_ref, path, file_format):
+    """Carga un archivo local en la tabla mediante un load job."""
+    if file_format == 'parquet':
+        source_format = bigquery.SourceFormat.PARQUET
+    else:
+        source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+
+    job_config = bigquery.LoadJobConfig(
+        source_format=source_format,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+    )
+    with open(path, 'rb') as source_file:
+        load_job = client.load_table_from_file(source_file, table_ref, job_config=job_config)
+    load_job.result()
+    return load_job.output_rows
+
+
+def backfill(args):
+    """Convierte los archivos de entrada y los carga en BigQuery por bloques."""
+    table_ref = args.table or f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
+    client = None if args.dry_run else get_bigquery_client()
+    table_schema = client.get_table(table_ref).schema if client else None
+    field_types = {field.name: field.field_type for field in (table_schema or [])}
+
+    staging_dir = args.staging_dir or tempfile.mkdtemp(prefix='bigquery_bulk_')
+    os.makedirs(staging_dir, exist_ok=True)
+    manifest = None if args.dry_run else open_manifest(staging_dir, run_fingerprint(args, table_ref))
+    writer = ChunkWriter(staging_dir, file_format=args.format, chunk_rows=args.chunk_rows,
+                         table_schema=table_schema)
+
+    # Recent event keys, to drop Slack retry deliveries like processed_events does
+    seen_events = OrderedDict()
+    read, skipped, duplicates, loaded = 0, 0, 0, 0
+    for record in iter_records(args.inputs):
+        read += 1
+        event_key = slack_event_key(record) if isinstance(record, dict) and is_slack_event(record) else None
+        if event_key is not None:
+            if event_key in seen_events:
+                duplicates += 1
+                continue
+            seen_events[event_key] = True
+            if len(seen_events) > args.dedupe_window:
+                seen_events.popitem(last=False)
+
+        try:
+            row = to_chat_message_row(record, bot_user_id=args.bot_user_id, field_types=field_types)
+        except (ValueError, TypeError, OverflowError) as e:
+            logger.warning(f"Registro {read} inválido, omitido: {str(e)}")
+            row = None
+        if row is None:
+            skipped += 1
+            continue
+        writer.write(row)
+
+        # Load each chunk as soon as it is complete so local disk usage stays bounded
+        while client and writer.completed:
+            loaded += _load_and_cleanup(client, table_ref, writer.completed.pop(0), args, manifest)
+
+    remaining = writer.close()
+    if client:
+        for chunk in remaining:
+            loaded += _load_and_cleanup(client, table_ref, chunk, args, manifest)
+
+    logger.info(f"Registros leídos: {read}, omitidos: {skipped}, duplicados: {duplicates}, filas cargadas: {loaded}")
+    if args.dry_run:
+        logger.info(f"Dry run: archivos generados en {staging_dir}")
+    return True
+
+
+def _load_and_cleanup(client, table_ref, chunk, args, manifest):
+    path, rows = chunk
+    chunk_name = os.path.basename(path)
+
+    if chunk_name in manifest['chunks']:
+        logger.info(f"Omitiendo {chunk_name}: ya se cargó en una ejecución anterior")
+        output_rows = 0
+    else:
+        logger.info(f"Cargando {path} ({rows} filas) en {table_ref}...")
+        output_rows = load_file(client, table_ref, path, args.format)
+        # Record the chunk so a re-run of the same load doesn't load it twice
+        manifest['chunks'].append(chunk_name)
+        write_manifest(manifest)
+
+    if not args.keep_files:
+        os.remove(path)
+    return output_rows or 0
+
+
+def run_fingerprint(args, table_ref):
+    """Identifica una carga: archivos de entrada (ruta, tamaño y fecha) y opciones que definen los bloques."""
+    inputs = []
+    for path in args.inputs:
+        if path == '-':
+            inputs.append({'path': '-'})
+            continue
+        stat = os.stat(path)
+        inputs.append({'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': int(stat.st_mtime)})
+    return {
+        'inputs': inputs,
+        'table': table_ref,
+        'format': args.format,
+        'chunk_rows': args.chunk_rows,
+        'bot_user_id': args.bot_user_id,
+        'dedupe_window': args.dedupe_window,
+    }
+
+
+def open_manifest(staging_dir, fingerprint):
+    """Lee el manifiesto de bloques cargados o crea uno nuevo para esta carga.
+
+    Raises:
+        ValueError: Si el directorio tiene el manifiesto de otra carga, o si se
+            intenta reanudar una carga leída desde stdin.
+    """
+    manifest_path = os.path.join(staging_dir, LOADED_MANIFEST)
+    if not os.path.exists(manifest_path):
+        manifest = {'path': manifest_path, 'fingerprint': fingerprint, 'chunks': []}
+        write_manifest(manifest)
+        return manifest
+
+    with open(manifest_path, encoding='utf-8') as manifest_file:
+        saved = json.load(manifest_file)
+    if saved.get('fingerprint') != fingerprint:
+        raise ValueError(
+            f"{manifest_path} pertenece a otra carga (entradas, --format, --chunk-rows u opciones distintas); "
+            "usa otro --staging-dir"
+        )
+    if any(item['path'] == '-' for item in fingerprint['inputs']) and saved.get('chunks'):
+        raise ValueError("No se puede reanudar una carga leída desde stdin; usa otro --staging-dir")
+
+    logger.info(f"Reanudando carga: {len(saved['chunks'])} bloques ya cargados")
+    return {'path': manifest_path, 'fingerprint': fingerprint, 'chunks': saved.get('chunks', [])}
+
+
+def write_manifest(manifest):
+    """Guarda el manifiesto de forma atómica para no perderlo si la carga se interrumpe."""
+    temp_path = manifest['path'] + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump({'fingerprint': manifest['fingerprint'], 'chunks': manifest['chunks']}, manifest_file, indent=2)
+    os.replace(temp_path, manifest['path'])
+
+
+def export(args):
+    """Exporta las filas de un rango de fechas a un archivo local."""
+    table_ref = args.table or f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
+    start = date.fromisoformat(args.start)
+    end = date.fromisoformat(args.end)
+    if end < start:
+        raise ValueError("--end debe ser igual o posterior a --start")
+
+    client = get_bigquery_client()
+    query = f"""
+        SELECT *
+        FROM `{table_ref}`
+        WHERE DATE({args.date_column}) BETWEEN @start AND @end
+        ORDER BY {args.date_column}
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("start", "DATE", start),
+            bigquery.ScalarQueryParameter("end", "DATE", end),
+        ]
+    )
+    results = client.query(query, job_config=job_config).result(page_size=args.page_size)
+
+    exported = 0
+    if args.format == 'parquet':
+        import pyarrow.parquet as pq
+
+        writer = None
+        # Stream record batches (uses the BigQuery Storage API when it is installed)
+        for batch in results.to_arrow_iterable():
+            if writer is None:
+                writer = pq.ParquetWriter(args.output, batch.schema, compression='snappy')
+            writer.write_batch(batch)
+            exported += batch.num_rows
+        if writer is not None:
+            writer.close()
+    else:
+        with open_text(args.output, 'wt') as output_file:
+            csv_writer = None
+            for row in results:
+                record = dict(row.items())
+                if args.format == 'csv':
+                    if csv_writer is None:
+                        csv_writer = csv.DictWriter(output_file, fieldnames=list(record.keys()))
+                        csv_writer.writeheader()
+                    csv_writer.writerow(record)
+                else:
+                    output_file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                exported += 1
+
+    logger.info(f"Filas exportadas: {exported} ({args.start} a {args.end}) -> {args.output}")
+    return True
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Carga masiva y exportación de la tabla chat_messages en BigQuery"
+    )
+    parser.add_argument('--table', help="Tabla destino/origen (proyecto.dataset.tabla)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    load_parser = subparsers.add_parser('load', help="Cargar archivos NDJSON históricos mediante load jobs")
+    load_parser.add_argument('inputs', nargs='+', help="Archivos NDJSON (.jsonl, .json, .gz) o '-' para stdin")
+    load_parser.add_argument('--format', choices=['ndjson', 'parquet'], default='ndjson',
+                             help="Formato de los archivos locales a cargar (parquet requiere pyarrow)")
+    load_parser.add_argument('--chunk-rows', type=int, default=500000, help="Filas por load job")
+    load_parser.add_argument('--staging-dir',
+                             help="Directorio para los archivos intermedios; al repetir la carga con el mismo "
+                                  "directorio se omiten los bloques ya cargados")
+    load_parser.add_argument('--keep-files', action='store_true', help="No borrar los archivos después de cargarlos")
+    load_parser.add_argument('--bot-user-id', default=os.getenv("SLACK_BOT_USER_ID"),
+                             help="User ID del bot para quitar sus menciones (por defecto se toma de authorizations)")
+    load_parser.add_argument('--dedupe-window', type=int, default=DEDUPE_WINDOW,
+                             help="Eventos recientes recordados para descartar reintentos de Slack")
+    load_parser.add_argument('--dry-run', action='store_true', help="Solo generar los archivos, sin cargar")
+    load_parser.set_defaults(func=backfill)
+
+    export_parser = subparsers.add_parser('export', help="Exportar un rango de fechas")
+    export_parser.add_argument('--start', required=True, help="Fecha inicial (YYYY-MM-DD)")
+    export_parser.add_argument('--end', default=date.today().isoformat(), help="Fecha final inclusiva (YYYY-MM-DD)")
+    export_parser.add_argument('--output', required=True, help="Archivo de salida (.gz para comprimir) o '-' para stdout")
+    export_parser.add_argument('--format', choices=['ndjson', 'csv', 'parquet'], default='ndjson')
+    export_parser.add_argument('--date-column', choices=['created_at', 'message_ts', 'updated_at'], default='created_at')
+    export_parser.add_argument('--page-size', type=int, default=10000, help="Filas por página de resultados")
+    export_parser.set_defaults(func=export)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        success = args.func(args)
+    except Exception as e:
+        logger.error(f"ERROR: {str(e)}", exc_info=True)
+        success = False
+    sys.exit(0 if success else 1)
@@ -0,0 +1,349 @@
+import os
+import gc
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+from loguru import logger
+
+# Memory configuration. The container is capped at 512M in docker-compose.yml,
+# so the soft limit has to stay below it to leave room for eviction to work.
+# The limit is compared with the larger of this process' RSS and the container
+# working set, since several workers share the same cgroup limit.
+MEMORY_SOFT_LIMIT_MB = int(os.getenv("MEMORY_SOFT_LIMIT_MB", "400"))
+# After an eviction, evict again only once usage has dropped below this mark
+# or the cooldown has passed: freed memory is rarely returned to the OS.
+MEMORY_RESUME_MB = int(os.getenv("MEMORY_RESUME_MB", str(int(MEMORY_SOFT_LIMIT_MB * 0.85))))
+MEMORY_EVICTION_COOLDOWN = int(os.getenv("MEMORY_EVICTION_COOLDOWN", "600"))
+if MEMORY_RESUME_MB > MEMORY_SOFT_LIMIT_MB:
+    # A resume mark above the limit would re-arm on every check and never evict
+    logger.warning(
+        f"MEMORY_RESUME_MB ({MEMORY_RESUME_MB}) is above MEMORY_SOFT_LIMIT_MB ({MEMORY_SOFT_LIMIT_MB}), using the soft limit"
+    )
+    MEMORY_RESUME_MB = MEMORY_SOFT_LIMIT_MB
+MEMORY_CHECK_INTERVAL = int(os.getenv("MEMORY_CHECK_INTERVAL", "30"))
+MEMORY_HISTORY_SIZE = int(os.getenv("MEMORY_HISTORY_SIZE", "120"))
+MEMORY_TRACEMALLOC = os.getenv("MEMORY_TRACEMALLOC", "false").lower() in ("1", "true", "yes")
+
+# Registered internal structures: name -> {"obj": ..., "evict": callable}
+_stores: Dict[str, Dict[str, Any]] = {}
+# Last/peak sizes of transient structures (e.g. conversation lists)
+_gauges: Dict[str, Dict[str, Any]] = {}
+# RSS samples as (timestamp, rss_bytes)
+_rss_history: deque = deque(maxlen=MEMORY_HISTORY_SIZE)
+_eviction_stats = {"count": 0, "last_at": None, "last_reason": None, "last_rss_bytes": None}
+# Soft-limit eviction state: armed again when usage drops below MEMORY_RESUME_MB
+_eviction_armed = True
+_last_soft_eviction = 0.0
+
+_lock = threading.Lock()
+_monitor_thread: Optional[threading.Thread] = None
+
+
+def register_store(name: str, obj: Any, evict: Optional[Callable[[], None]] = None):
+    """Registra una estructura interna para medir su tamaño y liberarla bajo presión.
+
+    Args:
+        name (str): Nombre con el que aparece en /debug/memory.
+        obj: La estructura a medir (set, dict, list...).
+        evict (callable, optional): Función que reduce la estructura cuando se
+            supera el límite suave de memoria.
+    """
+    with _lock:
+        _stores[name] = {"obj": obj, "evict": evict}
+
+
+def record_gauge(name: str, obj: Any):
+    """Registra el tamaño actual y máximo de una estructura transitoria."""
+    items = len(obj) if hasattr(obj, "__len__") else None
+    size = deep_sizeof(obj)
+    with _lock:
+        gauge = _gauges.setdefault(name, {"last_items": 0, "last_bytes": 0, "peak_items": 0, "peak_bytes": 0})
+        gauge["last_items"] = items
+        gauge["last_bytes"] = size
+        gauge["peak_items"] = max(gauge["peak_items"], items or 0)
+        gauge["peak_bytes"] = max(gauge["peak_bytes"], size)
+
+
+def deep_sizeof(obj: Any, max_depth: int = 4) -> int:
+    """Calcula el tamaño aproximado en bytes de un objeto y su contenido."""
+    seen = set()
+
+    def _sizeof(o, depth):
+        if id(o) in seen:
+            return 0
+        seen.add(id(o))
+        size = sys.getsizeof(o)
+        if depth >= max_depth:
+            return size
+        if isinstance(o, dict):
+            size += sum(_sizeof(k, depth + 1) + _sizeof(v, depth + 1) for k, v in list(o.items()))
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            size += sum(_sizeof(item, depth + 1) for item in list(o))
+        return size
+
+    try:
+        return _sizeof(obj, 0)
+    except Exception as e:
+        logger.debug(f"Could not size object: {str(e)}")
+        return 0
+
+
+def get_rss_bytes() -> int:
+    """Obtiene la memoria residente (RSS) actual del proceso en bytes."""
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    # Fall back to the peak RSS when /proc is not available (non-Linux)
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+    except Exception:
+        return 0
+
+
+def get_container_usage_bytes() -> int:
+    """Obtiene el working set del contenedor (uso del cgroup menos la caché inactiva).
+
+    Returns:
+        int: Bytes usados por todo el contenedor, o 0 si no hay cgroup disponible.
+    """
+    # cgroup v2 first, then cgroup v1
+    for usage_path, stat_path, inactive_key in (
+        ("/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory.stat", "inactive_file"),
+        ("/sys/fs/cgroup/memory/memory.usage_in_bytes", "/sys/fs/cgroup/memory/memory.stat", "total_inactive_file"),
+    ):
+        try:
+            with open(usage_path) as usage_file:
+                usage = int(usage_file.read().strip())
+        except (OSError, ValueError):
+            continue
+
+        inactive = 0
+        try:
+            with open(stat_path) as stat_file:
+                for line in stat_file:
+                    key, _, value = line.partition(" ")
+                    if key == inactive_key:
+                        inactive = int(value)
+                        break
+        except (OSError, ValueError):
+            pass
+        return max(usage - inactive, 0)
+    return 0
+
+
+def record_sample() -> int:
+    """Toma una muestra de RSS y la agrega al historial."""
+    rss = get_rss_bytes()
+    with _lock:
+        _rss_history.append((time.time(), rss))
+    return rss
+
+
+def rss_trend() -> Dict[str, Any]:
+    """Resume el historial de RSS: mínimo, máximo y pendiente en MB/minuto."""
+    with _lock:
+        samples = list(_rss_history)
+
+    if not samples:
+        return {"samples": 0}
+
+    values = [rss for _, rss in samples]
+    elapsed = samples[-1][0] - samples[0][0]
+    slope = ((values[-1] - values[0]) / (1024 * 1024)) / (elapsed / 60) if elapsed > 0 else 0.0
+    return {
+        "samples": len(samples),
+        "window_seconds": round(elapsed, 1),
+        "first_mb": round(values[0] / (1024 * 1024), 2),
+        "last_mb": round(values[-1] / (1024 * 1024), 2),
+        "min_mb": round(min(values) / (1024 * 1024), 2),
+        "max_mb": round(max(values) / (1024 * 1024), 2),
+        "slope_mb_per_minute": round(slope, 3),
+    }
+
+
+def store_sizes() -> Dict[str, Any]:
+    """Devuelve el número de elementos y el tamaño aproximado de cada estructura registrada."""
+    with _lock:
+        stores = dict(_stores)
+        gauges = {name: dict(values) for name, values in _gauges.items()}
+
+    sizes = {}
+    for name, store in stores.items():
+        obj = store["obj"]
+        sizes[name] = {
+            "items": len(obj) if hasattr(obj, "__len__") else None,
+            "bytes": deep_sizeof(obj),
+            "evictable": store["evict"] is not None,
+        }
+    for name, gauge in gauges.items():
+        sizes[name] = gauge
+    return sizes
+
+
+def top_allocations(limit: int = 10, key_type: str = "lineno", start: bool = False) -> Dict[str, Any]:
+    """Obtiene los principales puntos de asignación de memoria usando tracemalloc.
+
+    tracemalloc tiene un costo de memoria propio, por eso solo se activa cuando
+    se pide explícitamente con ``start``; mientras no esté activo no hay reporte.
+    """
+    if not tracemalloc.is_tracing():
+        if not start:
+            return {"tracing": False, "started": False, "top": []}
+        tracemalloc.start()
+        return {"tracing": True, "started": True, "top": []}
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+    stats = snapshot.statistics(key_type)
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "tracing": True,
+        "started": False,
+        "traced_current_mb": round(current / (1024 * 1024), 2),
+        "traced_peak_mb": round(peak / (1024 * 1024), 2),
+        "top": [
+            {
+                "location": str(stat.traceback[0]),
+                "size_kb": round(stat.size / 1024, 1),
+                "count": stat.count,
+            }
+            for stat in stats[:limit]
+        ],
+    }
+
+
+def stop_tracing():
+    """Detiene tracemalloc y libera la memoria de sus trazas."""
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def evict_caches(reason: str = "manual") -> Dict[str, Any]:
+    """Reduce las estructuras registradas y fuerza una recolección de basura.
+
+    Returns:
+        dict: RSS antes y después de la liberación y las estructuras vaciadas.
+    """
+    rss_before = get_rss_bytes()
+
+    with _lock:
+        stores = dict(_stores)
+
+    evicted = []
+    for name, store in stores.items():
+        if store["evict"] is None:
+            continue
+        try:
+            store["evict"]()
+            evicted.append(name)
+        except Exception as e:
+            logger.error(f"Error evicting {name}: {str(e)}")
+
+    # tracemalloc keeps a trace per allocated block, drop it under pressure
+    if reason == "soft_limit" and tracemalloc.is_tracing():
+        stop_tracing()
+        evicted.append("tracemalloc")
+
+    gc.collect()
+    rss_after = get_rss_bytes()
+
+    with _lock:
+        _eviction_stats["count"] += 1
+        _eviction_stats["last_at"] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        _eviction_stats["last_reason"] = reason
+        _eviction_stats["last_rss_bytes"] = rss_after
+
+    logger.warning(
+        f"Memory eviction ({reason}): {evicted} - RSS {rss_before / (1024 * 1024):.1f}MB -> {rss_after / (1024 * 1024):.1f}MB"
+    )
+    return {"evicted": evicted, "rss_before_bytes": rss_before, "rss_after_bytes": rss_after}
+
+
+def check_memory() -> int:
+    """Toma una muestra de memoria y libera caches si se supera el límite suave.
+
+    Para no liberar en cada intervalo mientras el RSS sigue alto, después de una
+    liberación solo se vuelve a liberar cuando el uso baja de MEMORY_RESUME_MB o
+    cuando pasa MEMORY_EVICTION_COOLDOWN.
+    """
+    global _eviction_armed, _last_soft_eviction
+
+    rss = record_sample()
+    if MEMORY_SOFT_LIMIT_MB <= 0:
+        return rss
+
+    usage = max(rss, get_container_usage_bytes())
+    if usage < MEMORY_RESUME_MB * 1024 * 1024:
+        _eviction_armed = True
+    elif usage > MEMORY_SOFT_LIMIT_MB * 1024 * 1024:
+        cooled_down = time.time() - _last_soft_eviction >= MEMORY_EVICTION_COOLDOWN
+        if _eviction_armed or cooled_down:
+            evict_caches(reason="soft_limit")
+            _eviction_armed = False
+            _last_soft_eviction = time.time()
+    return rss
+
+
+def memory_report(top: int = 10, trace: bool = False) -> Dict[str, Any]:
+    """Construye el reporte completo servido por /debug/memory.
+
+    Args:
+        top (int): Número de puntos de asignación a incluir (0 para omitirlos).
+        trace (bool): Inicia tracemalloc si todavía no está activo.
+    """
+    rss = record_sample()
+    with _lock:
+        evictions = dict(_eviction_stats)
+
+    report = {
+        "rss_mb": round(rss / (1024 * 1024), 2),
+        "container_mb": round(get_container_usage_bytes() / (1024 * 1024), 2),
+        "soft_limit_mb": MEMORY_SOFT_LIMIT_MB,
+        "resume_mb": MEMORY_RESUME_MB,
+        "structures": store_sizes(),
+        "trend": rss_trend(),
+        "gc": {"counts": gc.get_count(), "objects": len(gc.get_objects())},
+        "evictions": evictions,
+    }
+    if top > 0:
+        report["allocations"] = top_allocations(limit=top, start=trace)
+    return report
+
+
+def start_monitor():
+    """Inicia el hilo que vigila la memoria periódicamente (solo una vez)."""
+    global _monitor_thread
+
+    if MEMORY_TRACEMALLOC and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    if _monitor_thread is not None or MEMORY_CHECK_INTERVAL <= 0:
+        return
+
+    def _run():
+        while True:
+            try:
+                check_memory()
+            except Exception as e:
+                logger.error(f"Error in memory monitor: {str(e)}")
+            time.sleep(MEMORY_CHECK_INTERVAL)
+
+    _monitor_thread = threading.Thread(target=_run, name="memory-monitor", daemon=True)
+    _monitor_thread.start()
+    logger.info(f"Memory monitor started (soft limit: {MEMORY_SOFT_LIMIT_MB}MB, interval: {MEMORY_CHECK_INTERVAL}s)")